@@ -6,8 +6,8 @@ Flask 서비스 목적:
 
 핵심 노트:
 - 대칭(symmetric) 임베딩 모델을 사용하며, 쿼리/문서를 동일 방식으로 임베딩
-- Elasticsearch의 dense_vector를 코사인 유사도와 함께 사용
-- knn_search에서 Elasticsearch의 _score는 코사인 유사도(값이 클수록 더 유사함)
+- 임베딩이 단위 벡터로 정규화되므로 dense_vector는 dot_product 유사도 사용 (코사인과 동일, 길이 계산 생략)
+- knn_search에서 Elasticsearch의 _score는 (1 + cos) / 2 (cosine/dot_product 공통). similarity/threshold는 이 _score 기준
 """
 
 from flask import Flask, request, jsonify
@@ -20,10 +20,22 @@ from elastic_client import (
     seed_mapping,
     add_default_seeds,
     normalize_phrase,
+    seed_id,
+    init_seeds_matrix,
+    get_seeds_matrix,
+    add_to_seeds_matrix,
 )
-from embedder import get_embedding
+from elasticsearch.helpers import bulk, streaming_bulk
+from cachetools import TTLCache
+from embedder import get_embedding, get_embeddings_batch
 from datetime import datetime, timezone
 import hashlib
+import numpy as np
+import json
+import os
+import queue
+import threading
+import time
 
 app = Flask(__name__)
 
@@ -31,12 +43,166 @@ app = Flask(__name__)
 create_index(TELEGRAM_CHATS_INDEX_NAME, mapping)
 create_index(SEED_INDEX_NAME, seed_mapping)
 
+# /seed-matches kNN 상위 1개 결과 캐시: (입력 텍스트 해시, 라벨 필터) → hit
+# 반복 입력은 임베딩과 kNN 호출을 모두 생략. 시드 추가 시 비우고, 그 외 변경은 TTL로 반영
+_top_hit_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+_top_hit_cache_lock = threading.Lock()
+# /seeds가 캐시를 비울 때마다 증가. 검색 전에 읽은 세대와 다르면 (비우기 전 상태로 검색한 결과이므로) 캐시에 넣지 않음
+_top_hit_cache_generation = 0
+
+# /embed 비동기 색인: 요청은 큐에 넣고 즉시 202 반환, 백그라운드 스레드가 모아서 임베딩 + bulk 색인
+EMBED_QUEUE_MAXSIZE = 10_000
+EMBED_DRAIN_SIZE = 256
+
+_embed_queue: "queue.Queue[tuple[str, dict]]" = queue.Queue(maxsize=EMBED_QUEUE_MAXSIZE)
+
+def _drain_embed_queue() -> list[tuple[str, dict]]:
+    """첫 메시지를 기다린 뒤 대기 중인 메시지를 최대 EMBED_DRAIN_SIZE개까지 꺼냄."""
+    items = [_embed_queue.get()]
+    while len(items) < EMBED_DRAIN_SIZE:
+        try:
+            items.append(_embed_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+# bulk/전송 실패 시 재인코딩 없이 임베딩이 붙은 문서를 다시 큐에 넣고 점점 길게 대기
+EMBED_RETRY_BASE_SEC = 1.0
+EMBED_RETRY_MAX_SEC = 60.0
+
+def _encode_messages(items: list[tuple[str, dict]]) -> list[tuple[str, dict]]:
+    """임베딩이 없는 메시지만 한 번의 배치 인코딩으로 임베딩 추가. 배치 인코딩이 실패하면 건별로 재시도."""
+    pending = [(es_id, doc) for es_id, doc in items if "embedding" not in doc]
+    encoded = [(es_id, doc) for es_id, doc in items if "embedding" in doc]
+    if not pending:
+        return encoded
+    # 향후 검색을 위해 메시지를 임베딩으로 저장 (대칭 모델)
+    try:
+        vecs = get_embeddings_batch([doc["text"] for _, doc in pending])
+        return encoded + [(es_id, {**doc, "embedding": vec}) for (es_id, doc), vec in zip(pending, vecs)]
+    except Exception as e:
+        # 202로 접수된 메시지이므로 한 건의 인코딩 실패로 배치 전체를 버리지 않음
+        print(f"⚠️ 메시지 {len(pending)}건 배치 임베딩 실패, 건별 재시도: {e}")
+    for es_id, doc in pending:
+        try:
+            encoded.append((es_id, {**doc, "embedding": get_embedding(doc["text"])}))
+        except Exception as item_error:
+            print(f"⚠️ 메시지 임베딩 실패 (유실): {es_id}: {item_error}")
+    return encoded
+
+def _index_messages(items: list[tuple[str, dict]]):
+    """임베딩이 붙은 메시지를 한 번의 _bulk 요청으로 색인. 전송 오류는 호출자에게 전달."""
+    actions = [
+        {
+            "_op_type": "index",
+            "_index": TELEGRAM_CHATS_INDEX_NAME,
+            "_id": es_id,
+            "_source": doc,
+        }
+        for es_id, doc in items
+    ]
+    _, errors = bulk(es, actions, chunk_size=500, request_timeout=60, raise_on_error=False)
+    for error in errors:
+        print(f"⚠️ 메시지 색인 실패: {error}")
+
+def _requeue_messages(items: list[tuple[str, dict]]):
+    """색인하지 못한 메시지를 임베딩째 다시 큐에 넣음. 큐가 가득 차면 유실로 기록."""
+    for item in items:
+        try:
+            _embed_queue.put_nowait(item)
+        except queue.Full:
+            print(f"⚠️ 메시지 재시도 큐 가득 참 (유실): {item[0]}")
+
+def _embed_index_worker():
+    """큐에 쌓인 메시지를 배치로 임베딩 + 색인. 색인 실패 시 대기 후 재시도."""
+    retry_delay = EMBED_RETRY_BASE_SEC
+    while True:
+        items = _encode_messages(_drain_embed_queue())
+        if not items:
+            continue
+        try:
+            _index_messages(items)
+            retry_delay = EMBED_RETRY_BASE_SEC
+        except Exception as e:
+            # Elasticsearch 장애는 다시 인코딩해도 해결되지 않으므로 계산한 벡터를 유지한 채 재시도
+            print(f"⚠️ 메시지 {len(items)}건 색인 실패, {retry_delay:.0f}초 후 재시도: {e}")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, EMBED_RETRY_MAX_SEC)
+            _requeue_messages(items)
+
+threading.Thread(target=_embed_index_worker, name="embed-indexer", daemon=True).start()
+
+# 시드 수가 적으면 HNSW 탐색 대신 script_score로 전체 시드를 정확히 스코어링
+EXACT_SEARCH_MAX_SEEDS = 10_000
+# 더 적으면 Elasticsearch 없이 프로세스 내 시드 행렬과의 내적으로 판별
+LOCAL_SEARCH_MAX_SEEDS = 2_000
+KNN_NUM_CANDIDATES = 50
+
+def _count_seeds() -> int | None:
+    try:
+        return es.count(index=SEED_INDEX_NAME).get("count")
+    except Exception:
+        return None
+
+_seed_count = _count_seeds()
+USE_EXACT_SEED_SEARCH = _seed_count is not None and _seed_count < EXACT_SEARCH_MAX_SEEDS
+USE_LOCAL_SEED_SEARCH = _seed_count is not None and _seed_count < LOCAL_SEARCH_MAX_SEEDS
+
+# 시드 행렬은 요청 경로가 아닌 시작 시점에 한 번만 로드
+if USE_LOCAL_SEED_SEARCH:
+    init_seeds_matrix()
+
+def _lookup_knn(doc_id: str, filters: list | None = None) -> dict:
+    """저장된 메시지 임베딩을 ES가 직접 조회하는 kNN 절 (query_vector_builder.lookup)."""
+    knn = {
+        "field": "embedding",
+        "query_vector_builder": {
+            "lookup": {
+                "index": TELEGRAM_CHATS_INDEX_NAME,
+                "id": doc_id,
+                "path": "embedding",
+            }
+        },
+        "k": 1,
+        "num_candidates": KNN_NUM_CANDIDATES,
+    }
+    if filters:
+        knn["filter"] = filters
+    return knn
+
+def _cluster_may_support_lookup() -> bool:
+    """query_vector_builder.lookup은 ES 9.4+ 전용. 버전 확인 실패 시 사용하지 않음."""
+    try:
+        major, minor = (int(x) for x in es.info()["version"]["number"].split("-")[0].split(".")[:2])
+        return (major, minor) >= (9, 4)
+    except Exception:
+        return False
+
+# lookup 사용 가능 여부: None이면 아직 모름 → 메시지 참조 요청이 들어올 때 실제 조회 결과로 판정
+# (빈 인덱스로 시작하는 신규 배포에서도 메시지가 쌓인 뒤 사용 가능하도록 시작 시점에 확정하지 않음)
+_vector_lookup_supported: bool | None = None if _cluster_may_support_lookup() else False
+
+def _search_top_hit_by_lookup(doc_id: str, filters: list | None) -> dict | None:
+    """저장된 메시지 임베딩으로 시드 kNN 검색. 지원 여부가 미확정이면 결과로 판정."""
+    global _vector_lookup_supported
+    try:
+        res = es.search(index=SEED_INDEX_NAME, knn=_lookup_knn(doc_id, filters), source=["label", "phrase"], size=1)
+    except Exception:
+        # 메시지가 존재하는데도 조회가 실패했다면 클러스터/매핑이 lookup을 지원하지 않는 것
+        if _vector_lookup_supported is None and es.exists(index=TELEGRAM_CHATS_INDEX_NAME, id=doc_id):
+            _vector_lookup_supported = False
+        raise
+    _vector_lookup_supported = True
+    hits = res.get("hits", {}).get("hits", [])
+    return hits[0] if hits else None
+
 @app.route("/embed", methods=["POST"])
 def embed():
-    """채팅 메시지를 임베딩으로 생성해 색인.
+    """채팅 메시지를 임베딩으로 생성해 색인 (비동기).
 
     요구 JSON 필드: text, chat_id, message_id, nickname, username, is_bot, timestamp
     저장 위치: TELEGRAM_CHATS_INDEX_NAME, 문서 ID 형식은 "{chat_id}_{message_id}"
+    검증 후 색인 큐에 넣고 202 반환. 임베딩/색인은 백그라운드 스레드에서 처리
     """
     print("embed")
     data = request.json
@@ -44,16 +210,12 @@ def embed():
     chat_id = data.get("chat_id")
     message_id = data.get("message_id")
     
-    if not text:
+    # 큐에 넣은 뒤에는 오류를 돌려줄 수 없으므로 임베딩 가능한 문자열인지 미리 검증
+    if not isinstance(text, str) or not text.strip():
         return jsonify({"error": "No text provided"}), 400
     if chat_id is None or message_id is None:
         return jsonify({"error": "chat_id and message_id are required"}), 400
 
-    # 향후 검색을 위해 메시지를 임베딩으로 저장 (대칭 모델)
-    vector = get_embedding(text)
-    # 확인 로그: 임베딩 차원 수 출력
-    print(f"embedding length: {len(vector)}")
-
     es_id = f"{chat_id}_{message_id}"
 
     # timestamp 전처리: Unix timestamp를 ISO 형식으로 변환
@@ -82,11 +244,13 @@ def embed():
         "is_bot": data.get("is_bot"),
         "text": text,
         "timestamp": timestamp,
-        "embedding": vector
     }
 
-    es.index(index=TELEGRAM_CHATS_INDEX_NAME, id=es_id, document=doc)
-    return jsonify({"message": "Indexed successfully"}), 201
+    try:
+        _embed_queue.put_nowait((es_id, doc))
+    except queue.Full:
+        return jsonify({"error": "indexing queue is full"}), 503
+    return jsonify({"message": "Accepted for indexing", "id": es_id}), 202
 
 
 @app.route("/seeds", methods=["POST"])
@@ -99,6 +263,7 @@ def add_seeds():
 
     각 문구는 kNN 매칭을 위해 임베딩과 함께 저장
     """
+    global _top_hit_cache_generation
     data = request.json or {}
     label = data.get("label")
     phrases = data.get("phrases")
@@ -116,34 +281,78 @@ def add_seeds():
 
 
 
-    results = []
-    for p in phrases:
-        if not isinstance(p, str) or not p.strip():
-            continue
+    valid_phrases = [p for p in phrases if isinstance(p, str) and p.strip()]
+    # 대칭 모델: 시드 문구를 동일 방식으로 임베딩하여 색인 (한 번의 배치 인코딩)
+    vecs = get_embeddings_batch(valid_phrases)
+
+    # 같은 요청으로 추가되는 시드는 동일한 created_at 공유
+    now_iso = datetime.now(timezone.utc).isoformat()
+    actions = []
+    for p, vec in zip(valid_phrases, vecs):
         normalized = normalize_phrase(p)
-        es_id = hashlib.sha1(f"{label}|{normalized}".encode("utf-8")).hexdigest()
-        # 대칭 모델: 시드 문구를 동일 방식으로 임베딩하여 색인
-        vec = get_embedding(p)
+        es_id = seed_id(label, normalized)
         doc = {
             "label": label,
             "phrase": p,
             "phrase_normalized": normalized,
-            "created_at": datetime.now(timezone.utc).isoformat(),
+            "created_at": now_iso,
             "embedding": vec,
         }
-        res = es.index(index=SEED_INDEX_NAME, id=es_id, document=doc)
-        results.append({
+        actions.append({
+            "_op_type": "index",
+            "_index": SEED_INDEX_NAME,
+            "_id": es_id,
+            "_source": doc,
+        })
+
+    # 문구별 es.index 대신 한 번의 _bulk 요청으로 색인 (응답은 요청 순서대로 반환)
+    results = []
+    failed = 0
+    # refresh="wait_for": 검색에 반영된 뒤 반환해야 아래 캐시 무효화 후 이전 결과가 다시 캐시되지 않음
+    bulk_results = streaming_bulk(
+        es, actions, chunk_size=500, request_timeout=60, raise_on_error=False, refresh="wait_for"
+    )
+    indexed = []
+    for p, vec, (ok, item) in zip(valid_phrases, vecs, bulk_results):
+        res = item.get("index", {})
+        result = {
             "_id": res.get("_id"),
             "result": res.get("result"),
             "phrase": p,
             "label": label,
-        })
+        }
+        if not ok:
+            failed += 1
+            result["error"] = res.get("error")
+        else:
+            indexed.append((res.get("_id"), p, vec))
+        results.append(result)
+
+    # 색인된 시드만 프로세스 내 시드 행렬에 반영 (전체 재스캔/재임베딩 없이 방금 계산한 벡터 사용)
+    if indexed:
+        ids, indexed_phrases, indexed_vecs = zip(*indexed)
+        add_to_seeds_matrix(
+            list(ids), [label] * len(ids), list(indexed_phrases), np.asarray(indexed_vecs), LOCAL_SEARCH_MAX_SEEDS
+        )
 
+    # 새 시드가 기존 캐시된 상위 결과를 바꿀 수 있으므로 무효화 (행렬 반영 이후)
+    with _top_hit_cache_lock:
+        _top_hit_cache_generation += 1
+        _top_hit_cache.clear()
+
+    # 일부 문구만 실패하면 207, 전부 실패하면 500
+    if failed == 0:
+        status = 201
+    elif failed < len(results):
+        status = 207
+    else:
+        status = 500
     return jsonify({
-        "message": "Seeds indexed",
-        "count": len(results),
+        "message": "Seeds indexed" if failed == 0 else "Some seeds failed to index",
+        "count": len(results) - failed,
+        "failed": failed,
         "items": results
-    }), 201
+    }), status
 
 
 @app.route("/seed-matches", methods=["POST"])
@@ -153,17 +362,24 @@ def should_block():
     로직:
       - 입력과 시드를 동일 방식으로 임베딩
       - 시드 임베딩에 대해 kNN 상위 1개 검색
-      - Elasticsearch의 _score를 코사인 유사도로 해석
+      - Elasticsearch의 _score((1 + cos) / 2, cosine 매핑 시절과 동일한 스케일)를 유사도로 사용
       - 유사도 >= 임계값이면 차단으로 판단
 
     요청 JSON:
-      - text: 문자열 (필수)
+      - text: 문자열 (lookup을 쓸 수 없으면 필수)
+      - chat_id, message_id: 선택 — /embed로 이미 색인된 메시지면 저장된 임베딩을
+        Elasticsearch가 서버 측에서 조회(query_vector_builder.lookup)하여 임베딩 계산 생략
+        (ES 9.4 미만이거나 lookup이 실패하는 것으로 확인된 클러스터에서는 사용하지 않음)
       - threshold: [0,1] 범위의 실수, 기본값 0.8
       - label: 문자열(선택) 또는 labels: 문자열 배열(선택) — 시드 범위를 필터링
     """
     data = request.json or {}
     text = data.get("text")
-    if not text or not isinstance(text, str) or not text.strip():
+    chat_id = data.get("chat_id")
+    message_id = data.get("message_id")
+    has_text = isinstance(text, str) and bool(text.strip())
+    use_lookup = _vector_lookup_supported is not False and chat_id is not None and message_id is not None
+    if not has_text and not use_lookup:
         return jsonify({"error": "text is required"}), 400
 
     # 임계값 기본값 처리
@@ -174,34 +390,86 @@ def should_block():
 
     # 선택적 라벨 필터 구성
     filters = None
+    filter_labels = None
     if isinstance(data.get("label"), str) and data.get("label").strip():
         filters = [{"term": {"label": data.get("label")}}]
+        filter_labels = [data.get("label")]
     elif isinstance(data.get("labels"), list) and data.get("labels"):
         labels = [l for l in data.get("labels") if isinstance(l, str) and l.strip()]
         if labels:
             filters = [{"terms": {"label": labels}}]
+            filter_labels = labels
 
-    # 대칭 모델: 사용자 입력을 동일 방식으로 임베딩
-    vector = get_embedding(text)
+    def _search_top_hit_locally(matrix, vector) -> dict | None:
+        # 단위 벡터끼리의 내적 = 코사인 유사도. 라벨 필터는 불리언 마스크로 적용
+        _, seed_labels, seed_phrases, seed_vecs = matrix
+        if not len(seed_vecs):
+            return None
+        scores = seed_vecs @ vector
+        if filter_labels is not None:
+            mask = np.isin(seed_labels, filter_labels)
+            if not mask.any():
+                return None
+            scores = np.where(mask, scores, -np.inf)
+        idx = int(scores.argmax())
+        # ES dot_product _score와 같은 (1 + dot) / 2 스케일로 맞춰 임계값 비교 로직 공유
+        return {
+            "_source": {"label": seed_labels[idx], "phrase": seed_phrases[idx]},
+            "_score": (1.0 + float(scores[idx])) / 2,
+        }
 
-    def _search_top_hit() -> dict | None:
+    def _search_top_hit_by_text() -> dict | None:
+        # 대칭 모델: 사용자 입력을 동일 방식으로 임베딩
+        vector = get_embedding(text)
         try:
-            res = es.knn_search(
-                index=SEED_INDEX_NAME,
-                knn={
-                    "field": "embedding",
-                    "query_vector": vector,
-                    "k": 1,
-                    "num_candidates": 100,
-                },
-                _source=["label", "phrase"],
-                filter=filters,
-            )
+            # /seeds로 상한을 넘겨 행렬이 폐기됐으면 Elasticsearch 경로로 대체
+            matrix = get_seeds_matrix() if USE_LOCAL_SEED_SEARCH else None
+            if matrix is not None:
+                return _search_top_hit_locally(matrix, vector)
+            if USE_EXACT_SEED_SEARCH:
+                # kNN의 dot_product _score와 같은 (1 + dot) / 2 스케일로 반환 (음수 점수 불가)
+                res = es.search(
+                    index=SEED_INDEX_NAME,
+                    size=1,
+                    query={
+                        "script_score": {
+                            "query": {"bool": {"filter": filters}} if filters else {"match_all": {}},
+                            "script": {
+                                "source": "(1.0 + dotProduct(params.q, 'embedding')) / 2",
+                                "params": {"q": vector},
+                            },
+                        }
+                    },
+                    source=["label", "phrase"],
+                )
+            else:
+                res = es.knn_search(
+                    index=SEED_INDEX_NAME,
+                    knn={
+                        "field": "embedding",
+                        "query_vector": vector,
+                        "k": 1,
+                        "num_candidates": KNN_NUM_CANDIDATES,
+                    },
+                    _source=["label", "phrase"],
+                    filter=filters,
+                )
             hits_local = res.get("hits", {}).get("hits", [])
             return hits_local[0] if hits_local else None
         except Exception:
             return None
 
+    def _search_top_hit() -> dict | None:
+        if use_lookup:
+            try:
+                return _search_top_hit_by_lookup(f"{chat_id}_{message_id}", filters)
+            except Exception:
+                # 아직 색인되지 않은 메시지 등 → 텍스트가 있으면 텍스트 임베딩 경로로 대체
+                # 텍스트가 없으면 차단 안 함으로 판정하지 않고 오류로 전달
+                if not has_text:
+                    raise
+        return _search_top_hit_by_text()
+
     def _format_no_hit() -> tuple[dict, int]:
         return ({
             "block": False,
@@ -215,6 +483,7 @@ def should_block():
     def _format_with_hit(top: dict) -> tuple[dict, int]:
         top_label_local = top.get("_source", {}).get("label")
         raw_score_local = top.get("_score")
+        # _score는 (1 + cos) / 2. cosine 매핑과 같은 값이므로 기존 임계값 의미 그대로 사용
         sim_score_local = None if raw_score_local is None else float(raw_score_local)
         dist_local = None if sim_score_local is None else (1.0 - sim_score_local)
         block_local = (sim_score_local is not None) and (sim_score_local >= threshold)
@@ -226,7 +495,25 @@ def should_block():
             "threshold": threshold,
         }, 200)
 
-    top_hit = _search_top_hit()
+    # 임베딩 캐시와 동일하게 앞뒤 공백만 제거한 텍스트를 키로 사용
+    cache_key = None
+    if has_text:
+        text_key = hashlib.blake2b(text.strip().encode("utf-8"), digest_size=16).hexdigest()
+        cache_key = (text_key, json.dumps(filters, sort_keys=True))
+        with _top_hit_cache_lock:
+            top_hit = _top_hit_cache.get(cache_key)
+            generation = _top_hit_cache_generation
+    if cache_key is None or top_hit is None:
+        try:
+            top_hit = _search_top_hit()
+        except Exception as e:
+            return jsonify({"error": "message_lookup_failed", "detail": str(e)}), 502
+        if cache_key is not None and top_hit is not None:
+            with _top_hit_cache_lock:
+                # 검색 도중 /seeds가 캐시를 비웠다면 이전 시드 기준 결과이므로 저장하지 않음
+                if generation == _top_hit_cache_generation:
+                    _top_hit_cache[cache_key] = top_hit
+
     body, status = _format_no_hit() if top_hit is None else _format_with_hit(top_hit)
     return jsonify(body), status
 
@@ -257,4 +544,6 @@ def list_labels():
         return jsonify({"error": "failed_to_list_labels", "detail": str(e)}), 500
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True, port=5001)
+    # 요청별 스레드에서 들어온 임베딩 요청을 embedder의 마이크로 배처가 묶어서 처리
+    # 디버그 모드(리로더 자식 프로세스 포함)는 FLASK_DEBUG=1일 때만 사용
+    app.run(host="0.0.0.0", debug=os.getenv("FLASK_DEBUG") == "1", port=5001, threaded=True)
@@ -2,10 +2,14 @@ import os
 import re
 import hashlib
 import json
+import threading
+import numpy as np
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from elasticsearch import Elasticsearch
-from embedder import get_embedding
+from elasticsearch.helpers import bulk, scan
+from elasticsearch.serializer import OrjsonSerializer
+from embedder import get_embeddings_batch
 
 # .env 파일 로드
 load_dotenv()
@@ -16,7 +20,18 @@ ES_PASSWORD = os.getenv("ES_PASSWORD")
 TELEGRAM_CHATS_INDEX_NAME = os.getenv("TELEGRAM_CHATS_INDEX_NAME", "telegram-chats")
 SEED_INDEX_NAME = os.getenv("SEED_INDEX_NAME", "intent-seeds")
 
-es = Elasticsearch(ES_HOST, basic_auth=(ES_USER, ES_PASSWORD))
+# 프로세스 단위로 재사용되는 커넥션 풀 (keep-alive) + 벡터 페이로드 gzip 압축
+# orjson 직렬화: 임베딩 numpy 배열을 파이썬 list 변환 없이 바로 JSON으로 인코딩
+es = Elasticsearch(
+    ES_HOST,
+    basic_auth=(ES_USER, ES_PASSWORD),
+    serializer=OrjsonSerializer(),
+    http_compress=True,
+    request_timeout=10,
+    max_retries=2,
+    retry_on_timeout=True,
+    connections_per_node=10,
+)
 
 mapping = {
     "mappings": {
@@ -33,7 +48,12 @@ mapping = {
                 "type": "dense_vector",
                 "dims": 768,
                 "index": True,
-                "similarity": "cosine"
+                "similarity": "dot_product",
+                "index_options": {
+                    "type": "int8_hnsw",
+                    "m": 16,
+                    "ef_construction": 100
+                }
             }
         }
     }
@@ -42,6 +62,8 @@ mapping = {
 # 시드 인덱스 매핑 및 생성 함수
 seed_mapping = {
     "mappings": {
+        # 시드 벡터는 phrase로 다시 만들 수 있으므로 _source에서 제외 (채팅 메시지 벡터는 원본 보존)
+        "_source": { "excludes": ["embedding"] },
         "properties": {
             "label": { "type": "keyword" },
             "phrase": { "type": "text" },
@@ -51,7 +73,12 @@ seed_mapping = {
                 "type": "dense_vector",
                 "dims": 768,
                 "index": True,
-                "similarity": "cosine"
+                "similarity": "dot_product",
+                "index_options": {
+                    "type": "int8_hnsw",
+                    "m": 16,
+                    "ef_construction": 100
+                }
             }
         }
     }
@@ -68,6 +95,9 @@ def create_index(index_name: str, body: dict):
     else:
         print(f"⚠️ Index already exists: {index_name}")
 
+_WS_RE = re.compile(r"\s+")
+_TRAIL_PUNCT_RE = re.compile(r"[?!.。！？…]+$")
+
 def normalize_phrase(s: str) -> str:
     """키워드/문구 경량 표준화.
 
@@ -75,11 +105,18 @@ def normalize_phrase(s: str) -> str:
     - 임베딩은 원문 텍스트 사용. 이 정규화는 메타데이터 용도
     """
     s = (s or "").strip()
-    s = re.sub(r"\s+", " ", s)
-    s = re.sub(r"[?!.。！？…]+$", "", s)
+    s = _WS_RE.sub(" ", s)
+    s = _TRAIL_PUNCT_RE.sub("", s)
     s = s.casefold()
     return s
 
+def seed_id(label: str, normalized: str) -> str:
+    """라벨 + 정규화 문구로 시드 문서 ID 생성.
+
+    - 보안 용도가 아닌 안정적인 식별자이므로 짧은 입력에서 빠른 blake2b(160비트) 사용
+    """
+    return hashlib.blake2b(f"{label}|{normalized}".encode("utf-8"), digest_size=20).hexdigest()
+
 def add_default_seeds():
     """기본 시드 추가."""
     # JSON 파일에서 기본 시드 데이터 로드
@@ -94,7 +131,8 @@ def add_default_seeds():
         print(f"⚠️ default_seeds.json 포맷 오류: {e}")
         return
     
-    total_added = 0
+    # (label, phrase, normalized, es_id) 목록으로 평탄화 후 한 번에 임베딩
+    candidates = []
     for seed_data in default_seeds:
         label = seed_data["label"]
         phrases = seed_data["phrases"]
@@ -104,29 +142,111 @@ def add_default_seeds():
                 continue
                 
             normalized = normalize_phrase(phrase)
-            es_id = hashlib.sha1(f"{label}|{normalized}".encode("utf-8")).hexdigest()
-            
-            # 이미 존재하면 건너뛰기
-            if es.exists(index=SEED_INDEX_NAME, id=es_id):
-                continue
-                
-            # 임베딩 생성 후 저장
-            vec = get_embedding(phrase)
-            doc = {
-                "label": label,
-                "phrase": phrase,
-                "phrase_normalized": normalized,
-                "created_at": datetime.now(timezone.utc).isoformat(),
-                "embedding": vec,
-            }
-            
-            try:
-                es.index(index=SEED_INDEX_NAME, id=es_id, document=doc)
-                total_added += 1
-            except Exception as e:
-                print(f"⚠️ 시드 추가 실패: {label} - {phrase}: {e}")
+            es_id = seed_id(label, normalized)
+            candidates.append((label, phrase, normalized, es_id))
+
+    # 이미 존재하는 시드는 건너뛰기 (시드별 exists 대신 한 번의 mget으로 확인)
+    existing = set()
+    if candidates:
+        res = es.mget(index=SEED_INDEX_NAME, ids=[es_id for *_, es_id in candidates], source=False)
+        existing = {d["_id"] for d in res["docs"] if d.get("found")}
+    pending = [c for c in candidates if c[3] not in existing]
+
+    # 임베딩 생성 후 저장
+    vecs = get_embeddings_batch([phrase for _, phrase, _, _ in pending])
+
+    # 같은 요청으로 추가되는 시드는 동일한 created_at 공유
+    now_iso = datetime.now(timezone.utc).isoformat()
+    actions = []
+    for (label, phrase, normalized, es_id), vec in zip(pending, vecs):
+        doc = {
+            "label": label,
+            "phrase": phrase,
+            "phrase_normalized": normalized,
+            "created_at": now_iso,
+            "embedding": vec,
+        }
+        actions.append({
+            "_op_type": "index",
+            "_index": SEED_INDEX_NAME,
+            "_id": es_id,
+            "_source": doc,
+        })
+
+    # 시드별 es.index 대신 _bulk 요청으로 한 번에 색인
+    total_added, errors = bulk(es, actions, chunk_size=500, request_timeout=60, raise_on_error=False)
+    for error in errors:
+        print(f"⚠️ 시드 추가 실패: {error}")
     
     if total_added > 0:
         print(f"✅ Added {total_added} default seeds to {SEED_INDEX_NAME}")
     else:
         print("ℹ️ No new seeds added (all already exist)")
+
+def load_seeds_matrix() -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """시드 인덱스를 한 번 스캔해 (ids, labels, phrases, vecs) 반환.
+
+    - embedding은 _source에서 제외되어 있으므로 문구를 로컬에서 다시 임베딩
+    - vecs는 (N, 768) 단위 벡터 행렬. 시드 @ 쿼리 내적이 곧 코사인 유사도
+    """
+    # 방금 추가된 기본 시드가 스캔에 보이도록 refresh
+    es.indices.refresh(index=SEED_INDEX_NAME)
+    ids, labels, phrases = [], [], []
+    for hit in scan(es, index=SEED_INDEX_NAME, query={"query": {"match_all": {}}, "_source": ["label", "phrase"]}):
+        src = hit.get("_source", {})
+        ids.append(hit["_id"])
+        labels.append(src.get("label"))
+        phrases.append(src.get("phrase") or "")
+    vecs = np.asarray(get_embeddings_batch(phrases), dtype=np.float32)
+    return np.array(ids, dtype=object), np.array(labels, dtype=object), np.array(phrases, dtype=object), vecs
+
+# 프로세스 내 시드 행렬. 시작 시 한 번 로드하고 /seeds는 새 행만 반영한 사본으로 교체
+# 조회는 튜플 참조만 읽으므로 잠금 없이 진행 (쓰기끼리만 잠금으로 직렬화)
+_seeds_matrix = None
+_seeds_matrix_lock = threading.Lock()
+
+def init_seeds_matrix():
+    """시드 행렬을 로드해 프로세스 내 캐시로 설정 (서비스 시작 시 호출)."""
+    global _seeds_matrix
+    matrix = load_seeds_matrix()
+    with _seeds_matrix_lock:
+        _seeds_matrix = matrix
+
+def get_seeds_matrix() -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None:
+    """캐시된 시드 행렬 반환. 로드되지 않았거나 상한 초과로 폐기됐으면 None."""
+    return _seeds_matrix
+
+def add_to_seeds_matrix(ids: list[str], labels: list[str], phrases: list[str], vecs: np.ndarray, max_size: int):
+    """새로 색인된 시드를 행렬에 반영. 같은 ID는 덮어쓰고 나머지는 뒤에 추가.
+
+    - 한 번의 호출 안에서 같은 ID가 여러 번 오면("a"와 "a!") Elasticsearch와 같이 마지막 행만 반영
+    - 결과가 max_size 이상이면 행렬을 폐기(None)해 이후 조회는 Elasticsearch 경로 사용
+    """
+    global _seeds_matrix
+    rows = {}
+    for doc_id, label, phrase, vec in zip(ids, labels, phrases, vecs):
+        rows[doc_id] = (label, phrase, vec)
+    with _seeds_matrix_lock:
+        if _seeds_matrix is None:
+            return
+        cur_ids, cur_labels, cur_phrases, cur_vecs = _seeds_matrix
+        cur_ids, cur_labels, cur_phrases = cur_ids.copy(), cur_labels.copy(), cur_phrases.copy()
+        cur_vecs = cur_vecs.copy()
+        index = {doc_id: i for i, doc_id in enumerate(cur_ids)}
+        new_rows = []
+        for doc_id, (label, phrase, vec) in rows.items():
+            i = index.get(doc_id)
+            if i is None:
+                new_rows.append((doc_id, label, phrase, vec))
+                continue
+            cur_labels[i], cur_phrases[i], cur_vecs[i] = label, phrase, vec
+        if len(cur_ids) + len(new_rows) >= max_size:
+            _seeds_matrix = None
+            return
+        if new_rows:
+            new_ids, new_labels, new_phrases, new_vecs = zip(*new_rows)
+            cur_ids = np.concatenate([cur_ids, np.array(new_ids, dtype=object)])
+            cur_labels = np.concatenate([cur_labels, np.array(new_labels, dtype=object)])
+            cur_phrases = np.concatenate([cur_phrases, np.array(new_phrases, dtype=object)])
+            cur_vecs = np.vstack([cur_vecs, np.asarray(new_vecs, dtype=np.float32)])
+        _seeds_matrix = (cur_ids, cur_labels, cur_phrases, cur_vecs)
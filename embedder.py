@@ -1,21 +1,176 @@
 import os
+import time
+import queue
+import functools
+import threading
+from concurrent.futures import Future
+import numpy as np
 import torch
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+from onnx_export import MODEL_NAME, ONNX_MODEL_DIR, ONNX_QUANTIZED_FILE, export_onnx_model, load_quantized_model
 
 # CUDA/MPS 비활성화
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "0"
 
-torch.use_deterministic_algorithms(True)
+# 재현성보다 지연시간 우선: 결정적 커널 강제 없이 물리 코어 수만큼 연산 스레드 사용
+# (멀티 워커 배포 시 워커별 OMP_NUM_THREADS 환경변수로 스레드 수 조정)
 torch.set_float32_matmul_precision("high")
-torch.set_num_threads(1)
+# os.cpu_count()는 호스트 전체 코어 수라 컨테이너 CPU 제한(affinity)을 무시 → 실제 할당된 코어 수 사용
+torch.set_num_threads(int(os.getenv("OMP_NUM_THREADS", len(os.sched_getaffinity(0)))))
+torch.set_num_interop_threads(1)
 
-model = SentenceTransformer("jhgan/ko-sbert-multitask", device="cpu").eval()
+# 추론 백엔드: "onnx"(기본, int8 동적 양자화된 ONNX Runtime) 또는 "torch"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
 
-def get_embedding(text: str):
+def _load_onnx_model() -> SentenceTransformer:
+    """int8 양자화된 ONNX 모델 로드.
+
+    - 모델은 Docker 빌드 단계(onnx_export.py)에서 미리 export. 없으면(로컬 실행) 여기서 생성
+    - 토크나이저/mean pooling/정규화 모듈은 SentenceTransformer 구성 그대로 사용
+    """
+    if not os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_QUANTIZED_FILE)):
+        print(f"⚠️ 양자화 ONNX 모델 없음, export 수행: {ONNX_MODEL_DIR}")
+        export_onnx_model()
+    return load_quantized_model()
+
+if EMBEDDING_BACKEND == "onnx":
+    model = _load_onnx_model()
+else:
+    model = SentenceTransformer(MODEL_NAME, device="cpu").eval()
+    # BF16 가중치로 한 번 변환해 GEMM 메모리 대역폭을 절반으로
+    model[0].auto_model = model[0].auto_model.to(dtype=torch.bfloat16)
+
+# 토큰화가 짧은 입력의 병목이 되지 않도록 Rust 기반 fast 토크나이저 보장
+if not model.tokenizer.is_fast:
+    model.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+
+# forward pass는 한 번에 하나만 실행: 연산 스레드가 이미 모든 코어를 쓰므로
+# 마이크로 배처와 배치 인코딩(/embed 워커, /seeds, 시드 행렬 로드)이 겹치면 CPU 과점유
+# 잠금은 batch_size 조각 단위로만 잡아, 대량 인코딩 중에도 /seed-matches 배치가 사이사이 실행되도록 함
+_encode_lock = threading.Lock()
+
+def _forward(features: dict[str, torch.Tensor]) -> np.ndarray:
+    """토큰화된 입력을 한 번의 forward pass(Transformer + pooling)로 인코딩 (잠금 안에서 실행)."""
+    with _encode_lock, torch.inference_mode():
+        if EMBEDDING_BACKEND == "onnx":
+            vecs = model.forward(features)["sentence_embedding"]
+        else:
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                vecs = model.forward(features)["sentence_embedding"]
+        return torch.nn.functional.normalize(vecs.float(), p=2, dim=1).numpy()
+
+def _encode_slice(texts: list[str]) -> np.ndarray:
+    """한 조각을 토큰화 후 한 번의 forward pass로 인코딩 (토큰화는 잠금 밖에서 수행)."""
+    return _forward(model.tokenize(texts))
+
+def _encode(texts: list[str], batch_size: int) -> np.ndarray:
+    """배치 인코딩 후 단위 벡터(float32 numpy 배열)로 반환.
+
+    - torch 백엔드는 BF16 autocast로 forward pass 후 float32로 되돌려 정규화
+    - model.encode 대신 tokenize + forward를 직접 호출해 마이크로 배처와 같은 경로 사용
+    """
+    return np.concatenate([_encode_slice(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)])
+
+# 마이크로 배처: 동시 요청의 단건 임베딩을 모아 한 번의 forward pass로 처리
+BATCH_MAX_SIZE = 32
+BATCH_MAX_WAIT_SEC = 0.01
+# 토큰 길이 버킷 상한: 비슷한 길이끼리 인코딩해 패딩 토큰 연산을 줄임
+LENGTH_BUCKETS = (16, 32, 64, 128)
+
+_pending: "queue.Queue[tuple[str, Future]]" = queue.Queue()
+
+def _collect_batch() -> list[tuple[str, Future]]:
+    """첫 요청을 기다린 뒤 최대 BATCH_MAX_WAIT_SEC 동안 BATCH_MAX_SIZE개까지 모음."""
+    items = [_pending.get()]
+    deadline = time.monotonic() + BATCH_MAX_WAIT_SEC
+    while len(items) < BATCH_MAX_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            items.append(_pending.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return items
+
+def _bucket_by_length(items: list[tuple[str, Future]]) -> list[tuple[list[Future], dict[str, torch.Tensor]]]:
+    """한 번 토큰화한 결과를 토큰 수 기준 LENGTH_BUCKETS 구간별로 나눔.
+
+    - 길이는 attention mask에서 계산하므로 길이 측정용 토큰화를 따로 하지 않음
+    - 버킷마다 해당 행만 잘라내고, 버킷 내 최대 길이 뒤의 패딩 열은 제거
+    """
+    features = model.tokenize([text for text, _ in items])
+    lengths = features["attention_mask"].sum(dim=1).tolist()
+    rows: list[list[int]] = [[] for _ in LENGTH_BUCKETS]
+    for row, length in enumerate(lengths):
+        idx = next((i for i, limit in enumerate(LENGTH_BUCKETS) if length <= limit), len(LENGTH_BUCKETS) - 1)
+        rows[idx].append(row)
+    buckets = []
+    for bucket_rows in rows:
+        if not bucket_rows:
+            continue
+        max_len = max(lengths[row] for row in bucket_rows)
+        bucket_features = {key: value[bucket_rows, :max_len] for key, value in features.items()}
+        buckets.append(([items[row][1] for row in bucket_rows], bucket_features))
+    return buckets
+
+def _encode_bucket(futures: list[Future], features: dict[str, torch.Tensor]):
+    """한 버킷을 한 번의 forward pass로 인코딩하고 각 Future에 결과 전달."""
+    try:
+        vecs = _forward(features)
+    except Exception as e:
+        for future in futures:
+            future.set_exception(e)
+        return
+    for future, vec in zip(futures, vecs):
+        # 캐시에 공유되는 벡터이므로 읽기 전용으로 고정
+        vec.flags.writeable = False
+        future.set_result(vec)
+
+def _batch_worker():
+    """대기 중인 텍스트를 길이 버킷별 배치로 인코딩."""
+    while True:
+        items = _collect_batch()
+        try:
+            buckets = _bucket_by_length(items)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            continue
+        for futures, features in buckets:
+            _encode_bucket(futures, features)
+
+threading.Thread(target=_batch_worker, name="embed-batcher", daemon=True).start()
+
+@functools.lru_cache(maxsize=4096)
+def _embed_cached(text: str) -> np.ndarray:
+    """정규화된 텍스트의 임베딩을 프로세스 내 LRU 캐시에 보관.
+
+    - 반복되는 채팅 메시지/시드 문구는 forward pass 없이 반환
+    - 캐시 값이 공유되므로 읽기 전용 numpy 배열로 저장
+    - 캐시 미스는 마이크로 배처에 넘겨 다른 요청과 함께 인코딩
+    """
+    future: Future = Future()
+    _pending.put((text, future))
+    return future.result()
+
+def get_embedding(text: str) -> np.ndarray:
     """텍스트 임베딩 반환.
 
     - 대칭 임베딩 모델. 입력 종류와 무관하게 동일 방식으로 인코딩
     - 코사인 유사도 일관성을 위해 단위 벡터로 정규화
+    - 앞뒤 공백을 제거한 텍스트를 키로 캐시 (토크나이저가 어차피 무시하는 차이)
+    """
+    return _embed_cached(text.strip())
+
+def get_embeddings_batch(texts: list[str]) -> np.ndarray:
+    """여러 텍스트 임베딩을 한 번의 배치 인코딩으로 반환.
+
+    - 문구별 단건 호출 대신 forward pass를 배치 단위로 묶어 처리
+    - get_embedding과 동일하게 단위 벡터로 정규화
     """
-    return model.encode(text, normalize_embeddings=True).tolist()
+    if not texts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    return _encode(texts, batch_size=32)
@@ -0,0 +1,92 @@
+"""
+SBERT 모델 ONNX export + int8 동적 양자화.
+
+- Docker 빌드 단계(RUN python onnx_export.py)에서 실행해 컨테이너 시작 시 export/양자화를 반복하지 않음
+- 양자화 설정은 avx2 + reduce_range(7비트 가중치): VNNI가 없는 CPU에서도 u8s8 누산 포화가 생기지 않음
+- 양자화 후 기본 시드 문구 쌍의 코사인 점수를 FP32 모델과 비교
+  FP32에서 보정한 차단 임계값(DEFAULT_THRESHOLD)을 넘나드는 쌍이 생기면 빌드 실패
+- 동적 양자화는 배치 단위로 활성값 스케일을 계산하므로, 단건 인코딩(마이크로 배처에 혼자 들어온 쿼리)과
+  배치 인코딩(시드 행렬) 조합으로도 같은 검사를 수행
+"""
+
+import os
+import sys
+import json
+import numpy as np
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+MODEL_NAME = "jhgan/ko-sbert-multitask"
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(os.path.dirname(__file__), "onnx-model"))
+ONNX_QUANTIZED_SUFFIX = "qint8_avx2_reduce_range"
+ONNX_QUANTIZED_FILE = f"onnx/model_{ONNX_QUANTIZED_SUFFIX}.onnx"
+
+# /seed-matches 기본 임계값 0.85는 _score = (1 + cos) / 2 기준 → 코사인으로는 2 * 0.85 - 1 = 0.70
+DEFAULT_THRESHOLD = 0.70
+# 임계값 판정이 FP32와 달라져도 되는 시드 쌍 수 (기본 0: 판정이 하나라도 바뀌면 실패)
+MAX_THRESHOLD_FLIPS = int(os.getenv("ONNX_MAX_THRESHOLD_FLIPS", "0"))
+
+def export_onnx_model():
+    """ONNX_MODEL_DIR에 ONNX 모델과 int8 양자화 모델 저장."""
+    exported = SentenceTransformer(MODEL_NAME, device="cpu", backend="onnx")
+    exported.save_pretrained(ONNX_MODEL_DIR)
+    quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=True, reduce_range=True)
+    export_dynamic_quantized_onnx_model(
+        exported, quantization_config, ONNX_MODEL_DIR, file_suffix=ONNX_QUANTIZED_SUFFIX
+    )
+
+def load_quantized_model() -> SentenceTransformer:
+    return SentenceTransformer(
+        ONNX_MODEL_DIR,
+        device="cpu",
+        backend="onnx",
+        model_kwargs={"file_name": ONNX_QUANTIZED_FILE},
+    )
+
+def _pair_stats(reference: np.ndarray, candidate: np.ndarray) -> dict:
+    """시드 쌍(대각 제외) 점수의 차이와 임계값 판정이 바뀐 쌍 수."""
+    off_diag = ~np.eye(len(reference), dtype=bool)
+    ref_scores = reference[off_diag]
+    cand_scores = candidate[off_diag]
+    diff = np.abs(ref_scores - cand_scores)
+    flips = (ref_scores >= DEFAULT_THRESHOLD) != (cand_scores >= DEFAULT_THRESHOLD)
+    return {
+        "max_diff": float(diff.max()),
+        "mean_diff": float(diff.mean()),
+        "threshold_flips": int(flips.sum()),
+    }
+
+def compare_with_fp32() -> dict:
+    """기본 시드 문구로 FP32(PyTorch)와 int8(ONNX) 점수 비교.
+
+    - batched: 쿼리/시드 모두 배치 인코딩
+    - single_query: 쿼리는 단건 인코딩, 시드는 배치 인코딩 (서비스의 실제 조합)
+    """
+    json_path = os.path.join(os.path.dirname(__file__), "default_seeds.json")
+    with open(json_path, "r", encoding="utf-8") as f:
+        phrases = [p for seed in json.load(f) for p in seed["phrases"] if isinstance(p, str) and p.strip()]
+
+    fp32 = SentenceTransformer(MODEL_NAME, device="cpu").encode(phrases, normalize_embeddings=True)
+    quantized = load_quantized_model()
+    int8_batched = quantized.encode(phrases, batch_size=32, normalize_embeddings=True)
+    int8_single = np.vstack([quantized.encode([p], normalize_embeddings=True) for p in phrases])
+
+    fp32_scores = fp32 @ fp32.T
+    return {
+        "phrases": len(phrases),
+        "pairs_over_threshold_fp32": int((fp32_scores >= DEFAULT_THRESHOLD).sum() - len(phrases)),
+        "batched": _pair_stats(fp32_scores, int8_batched @ int8_batched.T),
+        "single_query": _pair_stats(fp32_scores, int8_single @ int8_batched.T),
+        "single_vs_batched_min_cos": float(np.min(np.sum(int8_single * int8_batched, axis=1))),
+    }
+
+if __name__ == "__main__":
+    export_onnx_model()
+    print(f"✅ Exported int8 ONNX model to {os.path.join(ONNX_MODEL_DIR, ONNX_QUANTIZED_FILE)}")
+
+    stats = compare_with_fp32()
+    print(f"ℹ️ FP32 vs int8 seed-pair cosine: {json.dumps(stats)}")
+    flips = max(stats["batched"]["threshold_flips"], stats["single_query"]["threshold_flips"])
+    if flips > MAX_THRESHOLD_FLIPS:
+        print(f"⚠️ int8에서 임계값 {DEFAULT_THRESHOLD} 판정이 바뀐 시드 쌍 {flips}개 > {MAX_THRESHOLD_FLIPS}: 재보정 필요")
+        sys.exit(1)